@@ -46,6 +46,18 @@ RECOMMENDED_COLUMNS = [
 ]
 OUTPUT_COLUMNS = REQUIRED_COLUMNS + RECOMMENDED_COLUMNS
 
+# Resource types the scrapers never read. Stylesheets are kept: jqGrid/PrimeFaces layout and
+# Playwright's visibility checks depend on them.
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media"})
+# Analytics/beacon hosts seen in the portal snapshots; nothing on the page depends on them.
+BLOCKED_URL_PARTS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "connect.facebook.net",
+    "go-mpulse.net",
+    "js.monitor.azure.com",
+)
+
 # Playwright selector hints. Update these if the portals change.
 DUBAI_CHAMBER_SELECTORS = {
     # Commercial Directory form fields
@@ -1,39 +1,39 @@
 ﻿import csv
 import logging
-from collections import Counter
+import sys
+from collections import defaultdict
 from pathlib import Path
 
 from config import DUBAI_CHAMBER_CODES_CSV, OUTPUT_COLUMNS, RAW_DIR, SOURCE_DUBAI_CHAMBER
 from utils import (
+    EMAIL_RE,
     merge_notes,
     normalize_company_name,
     normalize_phone,
     run_stamp,
     setup_logger,
     utc_now_iso,
-    validate_email,
     write_csv,
 )
 
 
 def read_raw_csvs():
-    rows = []
+    # Yield rows lazily so the raw dumps are never held in memory all at once.
     for source_dir in [RAW_DIR / "dubai_chamber", RAW_DIR / "sharjah_sedd", RAW_DIR / "dubai_ded"]:
         if not source_dir.exists():
             continue
         for path in source_dir.glob("*.csv"):
+            raw_path = str(path)
             with path.open("r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    row["_raw_path"] = str(path)
-                    rows.append(row)
-    return rows
+                for row in csv.DictReader(f):
+                    row["_raw_path"] = raw_path
+                    yield row
 
 
 def best_activity(existing, new, new_source):
     if not existing:
         return new
-    if new_source == SOURCE_DUBAI_CHAMBER and existing:
+    if new_source == SOURCE_DUBAI_CHAMBER:
         return new or existing
     if new and len(new) > len(existing):
         return new
@@ -41,22 +41,15 @@ def best_activity(existing, new, new_source):
 
 
 def merge_rows(existing, incoming):
-    existing_source = existing.get("source", "")
     incoming_source = incoming.get("source", "")
+    # Chamber contacts win over any other source; decide that once per merge.
+    prefer_incoming = incoming_source == SOURCE_DUBAI_CHAMBER and existing.get("source", "") != SOURCE_DUBAI_CHAMBER
 
-    existing_phone = existing.get("phone", "")
-    incoming_phone = incoming.get("phone", "")
-    if not existing_phone:
-        existing["phone"] = incoming_phone
-    elif existing_source != SOURCE_DUBAI_CHAMBER and incoming_source == SOURCE_DUBAI_CHAMBER:
-        existing["phone"] = incoming_phone or existing_phone
-
-    existing_email = existing.get("email", "")
-    incoming_email = incoming.get("email", "")
-    if not existing_email:
-        existing["email"] = incoming_email
-    elif existing_source != SOURCE_DUBAI_CHAMBER and incoming_source == SOURCE_DUBAI_CHAMBER:
-        existing["email"] = incoming_email or existing_email
+    for field in ("phone", "email"):
+        existing_value = existing.get(field, "")
+        incoming_value = incoming.get(field, "")
+        if not existing_value or (prefer_incoming and incoming_value):
+            existing[field] = incoming_value or existing_value
 
     existing["business_activity"] = best_activity(
         existing.get("business_activity", ""), incoming.get("business_activity", ""), incoming_source
@@ -82,6 +75,21 @@ def merge_rows(existing, incoming):
     return existing
 
 
+def row_signature(row):
+    # Expects a cleaned row: company_name, email and phone are already stripped.
+    # The first three fields double as the name/email/phone dedupe identifiers.
+    return (
+        normalize_company_name(row["company_name"]),
+        row["email"].lower(),
+        normalize_phone(row["phone"]),
+        (row.get("business_activity") or "").strip().lower(),
+        (row.get("source") or "").strip().lower(),
+        (row.get("activity_code") or "").strip().lower(),
+        (row.get("source_url") or "").strip().lower(),
+        (row.get("emirate") or "").strip().lower(),
+    )
+
+
 def main():
     stamp = run_stamp()
     log_path = Path("logs") / f"run_{stamp}.log"
@@ -99,94 +107,87 @@ def main():
                     if code:
                         chamber_codes.append(code)
 
-    raw_rows = read_raw_csvs()
-    if not raw_rows:
-        logging.warning("No raw CSV files found in raw/ directories")
-        return
-
-    cleaned = []
-    source_counts = Counter()
-    chamber_code_counts = Counter()
+    raw_count = 0
+    cleaned_count = 0
+    # One fallback timestamp per run; rows without last_seen_utc were all seen "now".
+    fallback_seen_utc = utc_now_iso()
+    source_counts = defaultdict(int)
+    chamber_code_counts = defaultdict(int)
+    merged = {}
+    seen_exact = set()
 
-    for row in raw_rows:
+    # Single pass: clean, count, and dedupe each row as it is read.
+    for row in read_raw_csvs():
+        raw_count += 1
         company = (row.get("company_name") or "").strip()
         if not company:
             continue
         row["company_name"] = company
 
         original_email = (row.get("email") or "").strip()
-        row["email"] = validate_email(original_email)
+        # Already stripped, so match the compiled pattern directly.
+        row["email"] = original_email if EMAIL_RE.fullmatch(original_email) else ""
         if original_email and not row["email"]:
             row["notes"] = merge_notes(row.get("notes", ""), "email_invalid_removed")
 
         row["phone"] = (row.get("phone") or "").strip()
 
-        row["last_seen_utc"] = row.get("last_seen_utc") or utc_now_iso()
+        row["last_seen_utc"] = row.get("last_seen_utc") or fallback_seen_utc
 
-        source = row.get("source", "")
+        # Low-cardinality fields: intern them so every row shares one string object per value.
+        source = row["source"] = sys.intern(row.get("source") or "")
+        row["emirate"] = sys.intern(row.get("emirate") or "")
+        code = row["activity_code"] = sys.intern(row.get("activity_code") or "")
         source_counts[source] += 1
 
         if source == SOURCE_DUBAI_CHAMBER:
-            code = row.get("activity_code", "")
             if code:
                 chamber_code_counts[code] += 1
 
-        cleaned.append(row)
-
-    merged = {}
-    seen_exact = set()
-    for idx, row in enumerate(cleaned):
-        norm_name = normalize_company_name(row.get("company_name", ""))
-        norm_email = row.get("email", "").lower().strip()
-        norm_phone = normalize_phone(row.get("phone", ""))
+        idx = cleaned_count
+        cleaned_count += 1
 
         # Exact duplicate guard: only remove rows that are identical across key fields.
-        exact_sig = (
-            norm_name,
-            norm_email,
-            norm_phone,
-            (row.get("business_activity") or "").strip().lower(),
-            (row.get("source") or "").strip().lower(),
-            (row.get("activity_code") or "").strip().lower(),
-            (row.get("source_url") or "").strip().lower(),
-            (row.get("emirate") or "").strip().lower(),
-        )
+        exact_sig = row_signature(row)
         if exact_sig in seen_exact:
             continue
         seen_exact.add(exact_sig)
+        norm_name, norm_email, norm_phone = exact_sig[:3]
 
         # Safer dedupe: only merge when company name AND (email OR phone) match.
         if norm_name and norm_email:
-            key = f"{norm_name}|{norm_email}"
+            key = ("email", norm_name, norm_email)
         elif norm_name and norm_phone:
-            key = f"{norm_name}|{norm_phone}"
+            key = ("phone", norm_name, norm_phone)
         else:
             # No strong identifiers, keep as unique row.
-            key = f"unique|{idx}"
+            key = ("unique", idx)
 
-        if key in merged:
-            merged[key] = merge_rows(merged[key], row)
-        else:
-            merged[key] = row
+        existing = merged.get(key)
+        merged[key] = row if existing is None else merge_rows(existing, row)
 
-    output_rows = []
-    for row in merged.values():
-        filtered = {col: (row.get(col, "") or "").strip() for col in OUTPUT_COLUMNS}
-        output_rows.append(filtered)
+    if not raw_count:
+        logging.warning("No raw CSV files found in raw/ directories")
+        return
+
+    # Generator: each output row is built as it is written, never held as a list.
+    # Missing and None values both collapse to "" through the `or`, so no .get default is needed.
+    output_columns = tuple(OUTPUT_COLUMNS)
+    output_rows = ({col: (row.get(col) or "").strip() for col in output_columns} for row in merged.values())
 
     output_path = Path("output") / "uae_oil_companies.csv"
     write_csv(output_rows, output_path, OUTPUT_COLUMNS)
 
-    logging.info("Merged %s rows into %s", len(output_rows), output_path)
-    for source, count in source_counts.items():
-        logging.info("Source %s: %s rows", source or "(unknown)", count)
+    logging.info("Merged %s rows into %s", len(merged), output_path)
+    summary = "\n".join(f"  {source or '(unknown)'}: {count} rows" for source, count in source_counts.items())
+    logging.info("Source breakdown:\n%s", summary)
 
-    if chamber_codes:
-        for code in chamber_codes:
-            if chamber_code_counts.get(code, 0) == 0:
-                logging.warning(
-                    "No rows captured for code %s (verify portal availability or update selectors)", code
-                )
+    missing_codes = [code for code in chamber_codes if code not in chamber_code_counts]
+    if missing_codes:
+        logging.warning(
+            "No rows captured for codes %s (verify portal availability or update selectors)",
+            ", ".join(missing_codes),
+        )
 
 
 if __name__ == "__main__":
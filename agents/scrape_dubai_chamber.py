@@ -1,11 +1,14 @@
 ﻿import argparse
+import asyncio
 import csv
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import sleep
 
-from bs4 import BeautifulSoup
-from playwright.sync_api import sync_playwright, TimeoutError
+import lxml.html
+from playwright.async_api import async_playwright, TimeoutError
 
 from config import (
     DUBAI_CHAMBER_CODES_CSV,
@@ -15,57 +18,80 @@ from config import (
     RAW_DIR,
     SOURCE_DUBAI_CHAMBER,
 )
-from utils import ensure_dir, run_stamp, setup_logger, utc_now_iso, validate_email
+from utils import (
+    SELECTOR_STATES_JS,
+    block_heavy_resources,
+    ensure_dir,
+    open_csv_writer,
+    remember_selector,
+    run_stamp,
+    save_html,
+    selector_candidates,
+    setup_logger,
+    utc_now_iso,
+    validate_email,
+)
 
 
-def first_visible(page, selectors, timeout=2000):
-    for selector in selectors:
+async def first_visible(page, selectors, timeout=2000):
+    candidates = selector_candidates(selectors)
+    try:
+        states = await page.evaluate(SELECTOR_STATES_JS, candidates)
+    except Exception:
+        states = ["other"] * len(candidates)
+    for selector, state in zip(candidates, states):
+        if state == "visible":
+            remember_selector(selectors, selector)
+            return page.locator(selector).first
+        if state == "missing":
+            continue
         try:
             locator = page.locator(selector).first
-            if locator.count() > 0:
-                locator.wait_for(state="visible", timeout=timeout)
+            if await locator.count() > 0:
+                await locator.wait_for(state="visible", timeout=timeout)
+                remember_selector(selectors, selector)
                 return locator
         except Exception:
             continue
     return None
 
 
-def click_search(page, search_selectors):
-    search_button = first_visible(page, search_selectors, timeout=5000)
+async def click_search(page, search_selectors):
+    search_button = await first_visible(page, search_selectors, timeout=5000)
     if not search_button:
         return False
     try:
-        search_button.scroll_into_view_if_needed()
+        await search_button.scroll_into_view_if_needed()
     except Exception:
         pass
     # Try normal click, then force, then JS click.
     try:
-        search_button.click()
+        await search_button.click()
         return True
     except Exception:
         pass
     try:
-        search_button.click(force=True)
+        await search_button.click(force=True)
         return True
     except Exception:
         pass
     try:
-        page.evaluate("el => el.click()", search_button)
+        await search_button.evaluate("el => el.click()")
         return True
     except Exception:
         return False
 
 
-def guess_table(page):
+async def guess_table(page):
     preferred = page.locator("table#s_2_l")
-    if preferred.count() > 0:
+    if await preferred.count() > 0:
         return preferred.first
     tables = page.locator("table")
-    count = tables.count()
+    count = await tables.count()
     for idx in range(count):
         table = tables.nth(idx)
         try:
-            header_text = " ".join(table.locator("th").all_inner_texts())
+            header_text = " ".join(await table.locator("th").all_inner_texts())
         except Exception:
             header_text = ""
         if "Company" in header_text or "Activity" in header_text or "Phone" in header_text:
@@ -75,103 +101,116 @@ def guess_table(page):
     return None
 
 
-def extract_table_rows(table):
-    rows = []
+# Reads a whole results table in one browser call instead of one call per row and cell.
+TABLE_ROWS_JS = """
+(table) => {
+  const isGrid = table.id === 's_2_l';
+  const grid = isGrid ? table.closest('#gview_s_2_l') : null;
+  const headerCells = isGrid ? (grid ? grid.querySelectorAll('th') : []) : table.querySelectorAll('tr th');
+  const text = el => (el.innerText || '').trim();
+  return {
+    headers: Array.from(headerCells).map(text),
+    rows: Array.from(table.querySelectorAll(isGrid ? 'tbody tr:not(.jqgfirstrow)' : 'tr'))
+      .map(tr => Array.from(tr.querySelectorAll('td')).map(text))
+      .filter(cells => cells.length > 0),
+  };
+}
+"""
+
+
+async def extract_table_rows(table):
+    data = await table.evaluate(TABLE_ROWS_JS)
     header_map = {}
-    table_id = table.get_attribute("id") or ""
-
-    if table_id == "s_2_l":
-        header_cells = table.locator("xpath=ancestor::div[@id='gview_s_2_l']//th")
-        if header_cells.count() > 0:
-            headers = [h.inner_text().strip() for h in header_cells.all()]
-            for i, header in enumerate(headers):
-                if header:
-                    header_map[header.lower()] = i
-        data_rows = table.locator("tbody tr:not(.jqgfirstrow)")
-    else:
-        header_cells = table.locator("tr th")
-        if header_cells.count() > 0:
-            headers = [h.strip() for h in header_cells.all_inner_texts()]
-            for i, header in enumerate(headers):
-                header_map[header.lower()] = i
-        data_rows = table.locator("tr")
-
-    for i in range(data_rows.count()):
-        row = data_rows.nth(i)
-        cells = row.locator("td")
-        if cells.count() == 0:
-            continue
-        values = [c.inner_text().strip() for c in cells.all()]
-        rows.append((values, row, header_map))
-    return rows
+    for i, header in enumerate(data["headers"]):
+        if header:
+            header_map[header.lower()] = i
+    return data["rows"], header_map
 
 
-def extract_grid_rows_via_dom(page):
+ROW_COUNTER_RE = re.compile(r'id="s_2_rc"[^>]*>\s*(\d+)\s*-\s*(\d+)\s+of\s+(\d+)(\+?)')
+
+
+def parse_row_counter(html: str):
     """
-    Direct DOM extraction for jqGrid rows; avoids relying on jqGrid API.
+    Read Siebel's row counter ("11 - 20 of 20+") as (first, last, total, more).
+    "+" means further record sets exist; without it, total is the final count.
     """
-    try:
-        rows = page.locator("#s_2_l tbody tr:not(.jqgfirstrow)")
-        out = []
-        for i in range(rows.count()):
-            row = rows.nth(i)
-            cells = [c.inner_text().strip() for c in row.locator("td").all()]
-            out.append(cells)
-        return out
-    except Exception:
-        return []
+    match = ROW_COUNTER_RE.search(html or "")
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2)), int(match.group(3)), bool(match.group(4))
 
 
 def parse_rows_from_html(html: str):
     """
-    HTML parsing fallback to avoid any locator timing issues.
+    HTML parsing fallback when the live grid read comes back empty; also re-parses saved snapshots offline.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    table = soup.select_one("#s_2_l")
     out = []
-    if not table:
+    if not html:
+        return out
+    tables = lxml.html.fromstring(html).xpath("//*[@id='s_2_l']")
+    if not tables:
         return out
-    for tr in table.select("tbody tr"):
-        if "jqgfirstrow" in (tr.get("class") or []):
+    for tr in tables[0].xpath(".//tbody//tr"):
+        if "jqgfirstrow" in (tr.get("class") or "").split():
             continue
-        cells = [td.get_text(strip=True) for td in tr.find_all("td")]
+        # Concatenated stripped fragments, mirroring BeautifulSoup's get_text(strip=True).
+        cells = ["".join(part.strip() for part in td.itertext()) for td in tr.iter("td")]
         out.append(cells)
     return out
 
 
-def extract_grid_rows_via_js(page):
-    """
-    Use page DOM to pull visible rows; more reliable than jqGrid API.
-    """
-    try:
-        data = page.evaluate(
-            """
+GRID_ROWS_JS = """
 () => {
   const table = document.querySelector('#s_2_l');
   if (!table) return [];
   const rows = Array.from(table.querySelectorAll('tbody tr:not(.jqgfirstrow)'));
-  return rows.map(tr => {
-    const cells = Array.from(tr.querySelectorAll('td')).map(td => (td.innerText || '').trim());
-    return {
-      member: cells[1] || '',
-      email: cells[2] || '',
-      phone: cells[3] || '',
-      activity: cells[4] || '',
-      raw: cells,
-    };
-  });
+  return rows.map(tr => Array.from(tr.querySelectorAll('td')).map(td => (td.innerText || '').trim()));
 }
 """
-        )
+
+
+async def extract_grid_rows_via_js(page):
+    """
+    Pull the grid's cell texts inside the browser; only the rows cross CDP.
+    """
+    try:
+        data = await page.evaluate(GRID_ROWS_JS)
         return data or []
     except Exception:
         return []
 
 
-def wait_for_grid_data(page, timeout_ms=20000):
-    try:
-        page.wait_for_function(
-            """
+# Snapshot of the grid before Next: first row text and record counter. Also resets the loader flag
+# GRID_PAGE_CHANGED_JS sets.
+GRID_STATE_JS = """
+() => {
+  window.__gridLoaderSeen = false;
+  const row = document.querySelector('#s_2_l tbody tr:not(.jqgfirstrow)');
+  const counter = document.querySelector('#s_2_rc');
+  return { row: row ? row.innerText : '', counter: counter ? counter.textContent.trim() : '' };
+}
+"""
+
+# Done once the loader has come and gone, or the first row or counter differs from the snapshot.
+# The counter covers a Next that keeps the same rows ("1 - 10 of 10+" becoming "1 - 10 of 10").
+GRID_PAGE_CHANGED_JS = """
+(prev) => {
+  const loader = document.querySelector('#load_s_2_l');
+  if (loader && getComputedStyle(loader).display !== 'none') {
+    window.__gridLoaderSeen = true;
+    return false;
+  }
+  if (window.__gridLoaderSeen) return true;
+  const row = document.querySelector('#s_2_l tbody tr:not(.jqgfirstrow)');
+  const counter = document.querySelector('#s_2_rc');
+  if (row && row.innerText !== prev.row) return true;
+  return !!counter && counter.textContent.trim() !== prev.counter;
+}
+"""
+
+
+GRID_READY_JS = """
 () => {
   const table = document.querySelector('#s_2_l');
   if (!table) return false;
@@ -182,9 +221,12 @@ def wait_for_grid_data(page, timeout_ms=20000):
   const text = (counter.textContent || '').trim().toLowerCase();
   return text && text !== 'no records';
 }
-""",
-            timeout=timeout_ms,
-        )
+"""
+
+
+async def wait_for_grid_data(page, timeout_ms=20000):
+    try:
+        await page.wait_for_function(GRID_READY_JS, timeout=timeout_ms)
         return True
     except Exception:
         return False
@@ -202,26 +244,246 @@ def find_row_value(values, header_map, candidates):
     return ""
 
 
-def extract_detail_fields(page, label_map):
+async def extract_detail_fields(page, label_map):
     result = {"company_name": "", "business_activity": "", "phone": "", "email": ""}
     for field, labels in label_map.items():
         for label in labels:
             try:
                 row = page.locator("tr", has_text=label).first
-                if row.count() > 0:
+                if await row.count() > 0:
                     cells = row.locator("td")
-                    if cells.count() >= 2:
-                        result[field] = cells.nth(1).inner_text().strip()
+                    if await cells.count() >= 2:
+                        result[field] = (await cells.nth(1).inner_text()).strip()
                         break
             except Exception:
                 continue
     return result
 
 
-def save_html(raw_dir, code, page_number, content):
-    ensure_dir(raw_dir)
-    path = raw_dir / f"{code}_page_{page_number:03d}.html"
-    path.write_text(content, encoding="utf-8")
+SIEBEL_SEARCH_JS = """
+() => {
+  try {
+    const app = window.SiebelApp && SiebelApp.S_App;
+    if (!app) return false;
+    const view = app.GetActiveView && app.GetActiveView();
+    if (!view) return false;
+    const applet = view.GetApplet && (view.GetApplet('Commercial Directory Form') || view.GetApplet('Commercial Directory'));
+    if (!applet) return false;
+    const pm = applet.GetPModel && applet.GetPModel();
+    if (!pm) return false;
+    pm.ExecuteMethod('InvokeMethod', 'Search');
+    pm.ExecuteMethod('InvokeMethod', 'ExecuteQuery');
+    return true;
+  } catch (e) {
+    return false;
+  }
+}
+"""
+
+
+async def scrape_code(page, code, args, html_dir, snapshots, writer, prompt_lock):
+    logging.info("Processing code %s", code)
+    rows_written = 0
+    try:
+        await page.goto(DUBAI_CHAMBER_URL, wait_until="load", timeout=60000)
+        # Allow any JS redirects/frames to settle without hard timeout failures.
+        await page.wait_for_load_state("networkidle", timeout=15000)
+    except TimeoutError:
+        logging.warning("Initial page load timed out; continuing with whatever rendered for code %s", code)
+    except Exception as e:
+        logging.error("Failed to open portal for code %s: %s", code, e)
+        return rows_written
+
+    clear_button = await first_visible(page, ["button[aria-label*='Clear']", "button[id*='_5_0_Ctrl']"], timeout=3000)
+    if clear_button:
+        try:
+            await clear_button.click()
+            await page.wait_for_timeout(500)
+        except Exception:
+            pass
+
+    input_box = await first_visible(page, DUBAI_CHAMBER_SELECTORS["activity_code_inputs"], timeout=8000)
+    if not input_box:
+        logging.warning("Activity code input not found for code %s. Try running with --slowmo 500 (headed).", code)
+        return rows_written
+    await input_box.fill(code)
+    # Blur the field to let the portal auto-populate description.
+    try:
+        await input_box.press("Tab")
+    except Exception:
+        pass
+
+    if args.pause_after_fill:
+        # One console prompt at a time when several workers are paused.
+        async with prompt_lock:
+            logging.info("Paused after fill for code %s. Click Search manually, then press Enter here.", code)
+            await asyncio.to_thread(input)
+
+    if not await click_search(page, DUBAI_CHAMBER_SELECTORS["search_buttons"]):
+        try:
+            await input_box.press("Enter")
+        except Exception:
+            logging.warning("Search trigger failed for code %s", code)
+
+    # Try Siebel JS invoke as fallback (sometimes the DOM click is ignored).
+    try:
+        await page.evaluate(SIEBEL_SEARCH_JS)
+    except Exception:
+        pass
+
+    if args.post_search_wait:
+        await page.wait_for_timeout(args.post_search_wait)
+    # Single readiness gate for page 1; later pages wait on the pager below.
+    if not await wait_for_grid_data(page, timeout_ms=25000):
+        logging.warning("No table rendered after search for code %s", code)
+
+    page_number = 1
+    prev_page_key = None
+    while True:
+        # Serialize the DOM once (the snapshot, row counter and fallback parser share it) while the
+        # grid rows are read from the live DOM; both calls are in flight together.
+        html, grid_rows = await asyncio.gather(page.content(), extract_grid_rows_via_js(page))
+        save_html(snapshots, html_dir, code, page_number, html)
+        if grid_rows:
+            logging.info("Code %s page %s: grid_rows=%s", code, page_number, len(grid_rows))
+        else:
+            grid_rows = parse_rows_from_html(html)
+            logging.info("Code %s page %s: grid_rows=0 html_rows=%s", code, page_number, len(grid_rows))
+
+        # The row counter's range identifies the page; the first row stands in when it is missing.
+        counter = parse_row_counter(html)
+        page_key = counter[:2] if counter else (tuple(grid_rows[0]) if grid_rows else None)
+        if page_key and page_key == prev_page_key:
+            logging.info("Page did not advance for code %s; stopping pagination.", code)
+            break
+        prev_page_key = page_key
+
+        # Grid cells are positional; header lookup is only needed for the generic table fallback.
+        header_map = {}
+        rows_data = grid_rows
+        if not rows_data:
+            # Fallback to table scraping
+            table = await guess_table(page)
+            if not table:
+                logging.warning("No results table detected for code %s", code)
+                break
+            rows_data, header_map = await extract_table_rows(table)
+
+        if not rows_data:
+            logging.info("No records found for code %s", code)
+            break
+
+        # Fields shared by every row on this page; one timestamp per page.
+        page_fields = {
+            "source": SOURCE_DUBAI_CHAMBER,
+            "emirate": "Dubai",
+            "activity_code": code,
+            "source_url": page.url,
+            "last_seen_utc": utc_now_iso(),
+            "notes": "",
+        }
+        for values in rows_data:
+            if header_map:
+                company = find_row_value(values, header_map, ["Company", "Trade Name", "Member Name"])
+                activity = find_row_value(
+                    values,
+                    header_map,
+                    ["Activity", "Business", "Product/Service", "Product Description"],
+                )
+            else:
+                company = values[1] if len(values) > 1 else (values[0] if values else "")
+                activity = ""
+            record = {
+                **page_fields,
+                "company_name": company,
+                "business_activity": activity,
+                "phone": values[3] if len(values) > 3 else "",
+                "email": validate_email(values[2]) if len(values) > 2 and values[2] else "",
+            }
+            writer.writerow(record)
+        rows_written += len(rows_data)
+
+        # A counter without "+" that reaches its total marks the last record set.
+        if counter and not counter[3] and counter[1] >= counter[2]:
+            break
+        if args.max_pages and page_number >= args.max_pages:
+            break
+
+        # Pagination handling for jqGrid pager
+        next_button = page.locator("#next_pager_s_2_l")
+        if await next_button.count() > 0:
+            try:
+                classes = await next_button.get_attribute("class") or ""
+                if "ui-state-disabled" in classes:
+                    break
+                prev_state = await page.evaluate(GRID_STATE_JS)
+                await next_button.click()
+                # Proceed as soon as the grid has reloaded or shows a different first row or counter.
+                try:
+                    await page.wait_for_function(GRID_PAGE_CHANGED_JS, arg=prev_state, timeout=15000)
+                except Exception:
+                    try:
+                        await page.wait_for_selector("#load_s_2_l", state="hidden", timeout=5000)
+                    except Exception:
+                        pass
+                page_number += 1
+            except Exception:
+                break
+        else:
+            # Fallback to generic "Next" button selectors
+            page_number += 1
+            next_button_generic = await first_visible(page, DUBAI_CHAMBER_SELECTORS["next_buttons"], timeout=1000)
+            if not next_button_generic:
+                break
+            try:
+                await next_button_generic.click()
+                await page.wait_for_timeout(1500)
+            except Exception:
+                break
+
+    return rows_written
+
+
+async def scrape_worker(browser, queue, args, html_dir, snapshots, out_file, writer, prompt_lock):
+    # Each worker owns a context, so Siebel sessions and cookies never mix between codes in flight.
+    context = await browser.new_context()
+    # Images, fonts and media are never parsed; skipping them cuts the bytes per Siebel navigation.
+    await context.route("**/*", block_heavy_resources)
+    page = await context.new_page()
+    rows_written = 0
+    try:
+        while True:
+            try:
+                code = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return rows_written
+            try:
+                rows_written += await scrape_code(page, code, args, html_dir, snapshots, writer, prompt_lock)
+            except Exception as e:
+                logging.error("Scrape failed for code %s: %s", code, e)
+            # Persist each finished code so a crash later in the run keeps it.
+            out_file.flush()
+    finally:
+        await context.close()
+
+
+async def scrape_codes(codes, args, html_dir, snapshots, out_file, writer):
+    prompt_lock = asyncio.Lock()
+    queue = asyncio.Queue()
+    for code in codes:
+        queue.put_nowait(code)
+    workers = max(1, min(args.concurrency, len(codes)))
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=args.headless, slow_mo=args.slowmo)
+        counts = await asyncio.gather(
+            *(
+                scrape_worker(browser, queue, args, html_dir, snapshots, out_file, writer, prompt_lock)
+                for _ in range(workers)
+            )
+        )
+        await browser.close()
+    return sum(counts)
 
 
 def main():
@@ -231,7 +493,8 @@ def main():
     parser.add_argument("--code", action="append", help="Process only specific activity code(s)")
     parser.add_argument("--slowmo", type=int, default=0)
     parser.add_argument("--pause-after-fill", action="store_true")
-    parser.add_argument("--post-search-wait", type=int, default=3000, help="extra wait in ms after search click")
+    parser.add_argument("--post-search-wait", type=int, default=0, help="extra wait in ms after search click")
+    parser.add_argument("--concurrency", type=int, default=4, help="activity codes scraped in parallel browser contexts")
     args = parser.parse_args()
 
     stamp = run_stamp()
@@ -255,215 +518,28 @@ def main():
             code = (row.get(code_field) or "").strip()
             if code:
                 codes.append(code)
+    # Drop repeated codes (keeping file order) so no code is scraped twice.
+    unique_codes = list(dict.fromkeys(codes))
+    if len(unique_codes) < len(codes):
+        logging.info("Skipping %s duplicate activity codes", len(codes) - len(unique_codes))
+    codes = unique_codes
     if args.code:
         codes = [code for code in codes if code in args.code]
 
-    out_rows = []
     html_dir = RAW_DIR / "dubai_chamber" / "html"
     ensure_dir(html_dir)
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=args.headless, slow_mo=args.slowmo)
-        page = browser.new_page()
-
-        for code in codes:
-            logging.info("Processing code %s", code)
-            try:
-                page.goto(DUBAI_CHAMBER_URL, wait_until="load", timeout=60000)
-                # Allow any JS redirects/frames to settle without hard timeout failures.
-                page.wait_for_load_state("networkidle", timeout=15000)
-            except TimeoutError:
-                logging.warning("Initial page load timed out; continuing with whatever rendered for code %s", code)
-            except Exception as e:
-                logging.error("Failed to open portal for code %s: %s", code, e)
-                continue
-
-            clear_button = first_visible(page, ["button[aria-label*='Clear']", "button[id*='_5_0_Ctrl']"], timeout=3000)
-            if clear_button:
-                try:
-                    clear_button.click()
-                    page.wait_for_timeout(500)
-                except Exception:
-                    pass
-
-            input_box = first_visible(page, DUBAI_CHAMBER_SELECTORS["activity_code_inputs"], timeout=8000)
-            if not input_box:
-                logging.warning("Activity code input not found for code %s. Try running with --slowmo 500 (headed).", code)
-                continue
-            input_box.fill(code)
-            # Blur the field to let the portal auto-populate description.
-            try:
-                input_box.press("Tab")
-            except Exception:
-                pass
-
-            if args.pause_after_fill:
-                logging.info("Paused after fill for code %s. Click Search manually, then press Enter here.", code)
-                input()
-
-            if not click_search(page, DUBAI_CHAMBER_SELECTORS["search_buttons"]):
-                try:
-                    input_box.press("Enter")
-                except Exception:
-                    logging.warning("Search trigger failed for code %s", code)
-
-            # Try Siebel JS invoke as fallback (sometimes the DOM click is ignored).
-            try:
-                page.evaluate(
-                    """
-() => {
-  try {
-    const app = window.SiebelApp && SiebelApp.S_App;
-    if (!app) return false;
-    const view = app.GetActiveView && app.GetActiveView();
-    if (!view) return false;
-    const applet = view.GetApplet && (view.GetApplet('Commercial Directory Form') || view.GetApplet('Commercial Directory'));
-    if (!applet) return false;
-    const pm = applet.GetPModel && applet.GetPModel();
-    if (!pm) return false;
-    pm.ExecuteMethod('InvokeMethod', 'Search');
-    pm.ExecuteMethod('InvokeMethod', 'ExecuteQuery');
-    return true;
-  } catch (e) {
-    return false;
-  }
-}
-"""
-                )
-            except Exception:
-                pass
-
-            page.wait_for_timeout(args.post_search_wait)
-            wait_for_grid_data(page, timeout_ms=25000)
-
-            page_number = 1
-            seen_page_keys = set()
-            while True:
-                page.wait_for_timeout(1000)
-                save_html(html_dir, code, page_number, page.content())
-
-                if page_number == 1:
-                    if not wait_for_grid_data(page, timeout_ms=15000):
-                        logging.warning("No table rendered after search for code %s", code)
-                html_rows = parse_rows_from_html(page.content())
-                grid_rows = extract_grid_rows_via_js(page)
-                dom_rows = extract_grid_rows_via_dom(page)
-                logging.info(
-                    "Code %s page %s: html_rows=%s dom_rows=%s grid_rows=%s",
-                    code,
-                    page_number,
-                    len(html_rows),
-                    len(dom_rows),
-                    len(grid_rows),
-                )
-
-                # Detect repeated pages to avoid infinite loops.
-                page_key = None
-                if html_rows:
-                    first_row = html_rows[0] if html_rows else []
-                    page_key = f"{len(html_rows)}|{first_row}"
-                elif dom_rows:
-                    first_row = dom_rows[0] if dom_rows else []
-                    page_key = f"{len(dom_rows)}|{first_row}"
-                elif grid_rows:
-                    first_row = grid_rows[0] if grid_rows else {}
-                    page_key = f"{len(grid_rows)}|{first_row}"
-                if page_key and page_key in seen_page_keys:
-                    logging.info("Page content repeated for code %s; stopping pagination.", code)
-                    break
-                if page_key:
-                    seen_page_keys.add(page_key)
-
-                if html_rows:
-                    rows_data = [(cells, None, {}) for cells in html_rows]
-                elif dom_rows:
-                    rows_data = [(cells, None, {}) for cells in dom_rows]
-                elif grid_rows:
-                    rows_data = [
-                        ([r.get("member", ""), r.get("email", ""), r.get("phone", ""), r.get("activity", "")], None, {})
-                        for r in grid_rows
-                    ]
-                else:
-                    # Fallback to table scraping
-                    table = guess_table(page)
-                    if not table:
-                        logging.warning("No results table detected for code %s", code)
-                        break
-                    rows_data = extract_table_rows(table)
-
-                if not rows_data:
-                    logging.info("No records found for code %s", code)
-                    break
-
-                for values, row, header_map in rows_data:
-                    if header_map:
-                        company = find_row_value(values, header_map, ["Company", "Trade Name", "Member Name"])
-                        activity = find_row_value(
-                            values,
-                            header_map,
-                            ["Activity", "Business", "Product/Service", "Product Description"],
-                        )
-                    else:
-                        company = values[1] if len(values) > 1 else (values[0] if values else "")
-                        activity = ""
-                    record = {
-                        "company_name": company,
-                        "business_activity": activity,
-                        "phone": values[3] if len(values) > 3 else "",
-                        "email": validate_email(values[2]) if len(values) > 2 else "",
-                        "source": SOURCE_DUBAI_CHAMBER,
-                        "emirate": "Dubai",
-                        "activity_code": code,
-                        "source_url": page.url,
-                        "last_seen_utc": utc_now_iso(),
-                        "notes": "",
-                    }
-                    out_rows.append(record)
-
-                # Pagination handling for jqGrid pager
-                next_button = page.locator("#next_pager_s_2_l")
-                if next_button.count() > 0:
-                    try:
-                        classes = next_button.get_attribute("class") or ""
-                        if "ui-state-disabled" in classes:
-                            break
-                        next_button.click()
-                        try:
-                            page.wait_for_selector("#load_s_2_l", state="visible", timeout=5000)
-                        except Exception:
-                            pass
-                        try:
-                            page.wait_for_selector("#load_s_2_l", state="hidden", timeout=15000)
-                        except Exception:
-                            page.wait_for_timeout(1500)
-                        page.wait_for_timeout(1000)
-                        page_number += 1
-                    except Exception:
-                        break
-                else:
-                    # Fallback to generic "Next" button selectors
-                    page_number += 1
-                    if args.max_pages and page_number > args.max_pages:
-                        break
-                    next_button_generic = first_visible(page, DUBAI_CHAMBER_SELECTORS["next_buttons"], timeout=1000)
-                    if not next_button_generic:
-                        break
-                    try:
-                        next_button_generic.click()
-                        page.wait_for_timeout(1500)
-                    except Exception:
-                        break
-
-        browser.close()
-
+    # Rows are written as they are scraped; exiting the blocks flushes the CSV and
+    # waits for every pending snapshot write.
     out_path = RAW_DIR / "dubai_chamber" / f"dubai_chamber_{stamp}.csv"
-    if out_rows:
-        from utils import write_csv
+    out_file, writer = open_csv_writer(out_path, OUTPUT_COLUMNS)
+    with out_file, ThreadPoolExecutor(max_workers=2) as snapshots:
+        row_count = asyncio.run(scrape_codes(codes, args, html_dir, snapshots, out_file, writer))
 
-        write_csv(out_rows, out_path, OUTPUT_COLUMNS)
-        logging.info("Saved %s rows to %s", len(out_rows), out_path)
+    if row_count:
+        logging.info("Saved %s rows to %s", row_count, out_path)
     else:
-        logging.warning("No rows captured")
+        logging.warning("No rows captured; %s holds only the header", out_path)
 
 
 if __name__ == "__main__":
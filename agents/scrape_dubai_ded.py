@@ -1,8 +1,9 @@
 ﻿import argparse
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-from bs4 import BeautifulSoup
+import lxml.html
 from playwright.sync_api import sync_playwright, TimeoutError
 
 from config import (
@@ -13,15 +14,41 @@ from config import (
     RAW_DIR,
     SOURCE_DUBAI_DED,
 )
-from utils import ensure_dir, run_stamp, setup_logger, utc_now_iso
+from utils import (
+    SELECTOR_STATES_JS,
+    block_heavy_resources,
+    ensure_dir,
+    open_csv_writer,
+    remember_selector,
+    run_stamp,
+    save_html,
+    selector_candidates,
+    setup_logger,
+    utc_now_iso,
+)
+
+LEADING_DIGIT_RE = re.compile(r"^\d+")
+POSTBACK_RE = re.compile(r"__doPostBack\('([^']+)'")
+RESULTS_TABLE_SELECTOR = "table:has(th:has-text('Activity Code'))"
 
 
 def first_visible(page, selectors, timeout=2000):
-    for selector in selectors:
+    candidates = selector_candidates(selectors)
+    try:
+        states = page.evaluate(SELECTOR_STATES_JS, candidates)
+    except Exception:
+        states = ["other"] * len(candidates)
+    for selector, state in zip(candidates, states):
+        if state == "visible":
+            remember_selector(selectors, selector)
+            return page.locator(selector).first
+        if state == "missing":
+            continue
         try:
             locator = page.locator(selector).first
             if locator.count() > 0:
                 locator.wait_for(state="visible", timeout=timeout)
+                remember_selector(selectors, selector)
                 return locator
         except Exception:
             continue
@@ -94,41 +121,56 @@ def guess_table(page):
     return None
 
 
+def node_text(node):
+    # Mirrors BeautifulSoup's get_text(strip=True): stripped text fragments, concatenated.
+    return "".join(part.strip() for part in node.itertext())
+
+
+def class_xpath(class_name, tag="*"):
+    return f".//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]"
+
+
 def parse_results_from_html(html: str):
-    soup = BeautifulSoup(html, "html.parser")
+    if not html:
+        return []
+    tree = lxml.html.fromstring(html)
     target = None
-    for table in soup.find_all("table"):
-        headers = [th.get_text(strip=True) for th in table.find_all("th")]
+    for table in tree.iter("table"):
+        headers = [node_text(th) for th in table.iter("th")]
         if "Activity Code" in headers and "Activity" in headers:
             target = table
             break
-    if not target:
+    if target is None:
         return []
     rows = []
-    for tr in target.find_all("tr"):
-        tds = [td.get_text(strip=True) for td in tr.find_all("td")]
-        if len(tds) >= 4 and re.match(r"^\d+", tds[0] or ""):
+    for tr in target.iter("tr"):
+        tds = [node_text(td) for td in tr.iter("td")]
+        if len(tds) >= 4 and LEADING_DIGIT_RE.match(tds[0] or ""):
             rows.append(tds[:4])
     return rows
 
 
 def parse_paging_info(html: str):
-    soup = BeautifulSoup(html, "html.parser")
     current = None
     total = None
-    current_span = soup.select_one(".paging-numbers .current")
-    total_span = soup.select_one(".paging-numbers .total")
+    next_target = None
+    if not html:
+        return current, total, next_target
+    tree = lxml.html.fromstring(html)
+    paging_numbers = tree.xpath(class_xpath("paging-numbers"))
+    current_span = paging_numbers[0].xpath(class_xpath("current")) if paging_numbers else []
+    total_span = paging_numbers[0].xpath(class_xpath("total")) if paging_numbers else []
     if current_span and total_span:
         try:
-            current = int(current_span.get_text(strip=True))
-            total = int(total_span.get_text(strip=True))
+            current = int(node_text(current_span[0]))
+            total = int(node_text(total_span[0]))
         except Exception:
             current = None
             total = None
-    next_link = soup.select_one(".paging-arrows a.next")
-    next_target = None
-    if next_link and next_link.get("href"):
-        match = re.search(r"__doPostBack\('([^']+)'", next_link.get("href"))
+    paging_arrows = tree.xpath(class_xpath("paging-arrows"))
+    next_link = paging_arrows[0].xpath(class_xpath("next", tag="a")) if paging_arrows else []
+    if next_link and next_link[0].get("href"):
+        match = POSTBACK_RE.search(next_link[0].get("href"))
         if match:
             next_target = match.group(1)
     return current, total, next_target
@@ -146,41 +188,16 @@ def last_row_key(rows):
     return "|".join(rows[-1][:2])
 
 
-def extract_table_rows(table):
-    rows = []
-    header_cells = table.locator("tr th")
-    header_map = {}
-    if header_cells.count() > 0:
-        headers = [h.strip() for h in header_cells.all_inner_texts()]
-        for i, header in enumerate(headers):
-            header_map[header.lower()] = i
-    data_rows = table.locator("tr")
-    for i in range(data_rows.count()):
-        row = data_rows.nth(i)
-        cells = row.locator("td")
-        if cells.count() == 0:
-            continue
-        values = [c.inner_text().strip() for c in cells.all()]
-        rows.append((values, header_map))
-    return rows
-
+# Cell texts of every row in one call; DED columns are positional, so headers are not read.
+TABLE_VALUES_JS = """
+(table) => Array.from(table.querySelectorAll('tr'))
+  .map(tr => Array.from(tr.querySelectorAll('td')).map(td => (td.innerText || '').trim()))
+  .filter(cells => cells.length > 0)
+"""
 
-def find_row_value(values, header_map, candidates):
-    if header_map:
-        for header, idx in header_map.items():
-            for candidate in candidates:
-                if candidate.lower() in header:
-                    if idx < len(values):
-                        return values[idx]
-    if values:
-        return values[0]
-    return ""
 
-
-def save_html(raw_dir, keyword, page_number, content):
-    ensure_dir(raw_dir)
-    path = raw_dir / f"{keyword}_page_{page_number:03d}.html"
-    path.write_text(content, encoding="utf-8")
+def extract_table_values(table):
+    return table.evaluate(TABLE_VALUES_JS)
 
 
 def captcha_present(page):
@@ -214,15 +231,23 @@ def main():
     log_path = RAW_DIR / "dubai_ded" / f"run_{stamp}.log"
     setup_logger(log_path)
 
-    keywords = args.keyword or KEYWORDS
+    keywords = list(dict.fromkeys(args.keyword or KEYWORDS))
 
-    out_rows = []
     html_dir = RAW_DIR / "dubai_ded" / "html"
     ensure_dir(html_dir)
 
-    with sync_playwright() as p:
+    # Rows are written as they are scraped; leaving the block flushes the CSV and
+    # waits for pending snapshot writes.
+    out_path = RAW_DIR / "dubai_ded" / f"dubai_ded_{stamp}.csv"
+    out_file, writer = open_csv_writer(out_path, OUTPUT_COLUMNS)
+    row_count = 0
+    with out_file, ThreadPoolExecutor(max_workers=2) as snapshots, sync_playwright() as p:
         browser = p.chromium.launch(headless=args.headless, slow_mo=args.slowmo)
-        page = browser.new_page()
+        # One context for the whole run; images, fonts and media are blocked on every page in it,
+        # including tabs opened from the landing page.
+        context = browser.new_context()
+        context.route("**/*", block_heavy_resources)
+        page = context.new_page()
 
         for keyword in keywords:
             logging.info("Searching keyword %s", keyword)
@@ -252,16 +277,26 @@ def main():
             else:
                 input_box.press("Enter")
 
-            page.wait_for_timeout(2000)
+            # The Search button triggers an invisible reCAPTCHA: stop waiting as soon as either the results
+            # or a challenge shows, so the operator is prompted right away.
+            try:
+                page.wait_for_selector(f"{RESULTS_TABLE_SELECTOR}, iframe[title*='challenge']", timeout=15000)
+            except Exception:
+                pass
             wait_for_captcha(page)
+            # After a solved challenge the search still has to post back and render the table.
+            try:
+                page.wait_for_selector(RESULTS_TABLE_SELECTOR, timeout=15000)
+            except Exception:
+                pass
 
             page_number = 1
             total_rows_for_keyword = 0
             seen_page_keys = set()
+            prev_current = None
             while True:
-                page.wait_for_timeout(1000)
                 html = page.content()
-                save_html(html_dir, keyword, page_number, html)
+                save_html(snapshots, html_dir, keyword, page_number, html)
 
                 rows_data = parse_results_from_html(html)
                 if not rows_data:
@@ -271,40 +306,50 @@ def main():
                         break
                     # Fallback to Playwright table parsing; filter to valid rows.
                     rows_data = []
-                    for values, _ in extract_table_rows(table):
-                        if len(values) >= 4 and re.match(r"^\d+", values[0] or ""):
+                    for values in extract_table_values(table):
+                        if len(values) >= 4 and LEADING_DIGIT_RE.match(values[0] or ""):
                             rows_data.append(values[:4])
 
                 logging.info("Keyword %s page %s: rows=%s", keyword, page_number, len(rows_data))
+                # DED lists activities, not companies: only the activity columns differ between rows.
+                page_fields = {
+                    "phone": "",
+                    "email": "",
+                    "source": SOURCE_DUBAI_DED,
+                    "emirate": "Dubai",
+                    "source_url": page.url,
+                    "last_seen_utc": utc_now_iso(),
+                    "notes": "ded_activity_search_no_company",
+                }
                 for values in rows_data:
                     # Columns: Activity Code, Activity, Activity Group, License Type
                     activity_code = values[0] if len(values) > 0 else ""
                     activity = values[1] if len(values) > 1 else ""
                     company = activity  # DED activities search doesn't list companies
                     record = {
+                        **page_fields,
                         "company_name": company,
                         "business_activity": activity,
-                        "phone": "",
-                        "email": "",
-                        "source": SOURCE_DUBAI_DED,
-                        "emirate": "Dubai",
                         "activity_code": activity_code,
-                        "source_url": page.url,
-                        "last_seen_utc": utc_now_iso(),
-                        "notes": "ded_activity_search_no_company",
                     }
-                    out_rows.append(record)
+                    writer.writerow(record)
                 total_rows_for_keyword += len(rows_data)
 
                 current, total, next_target = parse_paging_info(html)
-                page_key = f"{keyword}|{current or ''}|{first_row_key(rows_data)}|{last_row_key(rows_data)}"
-                if page_key in seen_page_keys:
-                    logging.info("Page content repeated for keyword %s; stopping pagination.", keyword)
-                    break
-                seen_page_keys.add(page_key)
-
-                if total and current and current >= total:
-                    break
+                if current is not None:
+                    # The pager is authoritative: stop on the last page or when a postback did not advance it.
+                    if current >= total:
+                        break
+                    if current == prev_current:
+                        logging.info("Pager did not advance for keyword %s; stopping pagination.", keyword)
+                        break
+                else:
+                    # No pager rendered: fall back to detecting a repeated page by its rows.
+                    page_key = f"{first_row_key(rows_data)}|{last_row_key(rows_data)}"
+                    if page_key in seen_page_keys:
+                        logging.info("Page content repeated for keyword %s; stopping pagination.", keyword)
+                        break
+                    seen_page_keys.add(page_key)
                 if args.max_pages and page_number >= args.max_pages:
                     break
 
@@ -312,7 +357,6 @@ def main():
                 if next_target:
                     try:
                         page.evaluate("t => __doPostBack(t, '')", next_target)
-                        page.wait_for_timeout(1500)
                     except Exception:
                         pass
                 else:
@@ -321,15 +365,17 @@ def main():
                         break
                     try:
                         next_button.click()
-                        page.wait_for_timeout(1500)
                     except Exception:
                         break
 
-                if prev_current is not None:
+                # Wait for the pager to move on; only fall back to a fixed delay without a page number.
+                if prev_current is None:
+                    page.wait_for_timeout(1500)
+                else:
                     try:
                         page.wait_for_function(
                             "prev => { const el=document.querySelector('.paging-numbers .current'); return el && el.textContent.trim() !== String(prev); }",
-                            prev_current,
+                            arg=prev_current,
                             timeout=10000,
                         )
                     except Exception:
@@ -338,17 +384,15 @@ def main():
                 page_number += 1
 
             logging.info("Keyword %s total rows captured: %s", keyword, total_rows_for_keyword)
+            row_count += total_rows_for_keyword
+            out_file.flush()
 
         browser.close()
 
-    out_path = RAW_DIR / "dubai_ded" / f"dubai_ded_{stamp}.csv"
-    if out_rows:
-        from utils import write_csv
-
-        write_csv(out_rows, out_path, OUTPUT_COLUMNS)
-        logging.info("Saved %s rows to %s", len(out_rows), out_path)
+    if row_count:
+        logging.info("Saved %s rows to %s", row_count, out_path)
     else:
-        logging.warning("No rows captured")
+        logging.warning("No rows captured; %s holds only the header", out_path)
 
 
 if __name__ == "__main__":
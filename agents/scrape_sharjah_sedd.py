@@ -1,8 +1,11 @@
 ﻿import argparse
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import quote
 
-from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright, TimeoutError
 
 from config import (
     KEYWORDS,
@@ -12,66 +15,118 @@ from config import (
     SHARJAH_SEDD_URL,
     SOURCE_SHARJAH_SEDD,
 )
-from utils import ensure_dir, run_stamp, setup_logger, utc_now_iso
+from utils import (
+    SELECTOR_STATES_JS,
+    block_heavy_resources,
+    ensure_dir,
+    normalize_company_name,
+    open_csv_writer,
+    remember_selector,
+    run_stamp,
+    save_html,
+    selector_candidates,
+    setup_logger,
+    utc_now_iso,
+)
 
 
-def first_visible(page, selectors, timeout=2000):
-    for selector in selectors:
+async def first_visible(page, selectors, timeout=2000):
+    candidates = selector_candidates(selectors)
+    try:
+        states = await page.evaluate(SELECTOR_STATES_JS, candidates)
+    except Exception:
+        states = ["other"] * len(candidates)
+    for selector, state in zip(candidates, states):
+        if state == "visible":
+            remember_selector(selectors, selector)
+            return page.locator(selector).first
+        if state == "missing":
+            continue
         try:
             locator = page.locator(selector).first
-            if locator.count() > 0:
-                locator.wait_for(state="visible", timeout=timeout)
+            if await locator.count() > 0:
+                await locator.wait_for(state="visible", timeout=timeout)
+                remember_selector(selectors, selector)
                 return locator
         except Exception:
             continue
     return None
 
 
-def input_by_label(page, label_text):
+# Field selector resolved from each label; the form is the same for every keyword and tab.
+_LABEL_CACHE = {}
+
+
+async def input_by_label(page, label_text):
+    cached = _LABEL_CACHE.get(label_text)
+    if cached:
+        field = page.locator(cached).first
+        try:
+            if await field.count() > 0:
+                return field
+        except Exception:
+            pass
     label = page.locator(f"label:has-text('{label_text}')").first
-    if label.count() == 0:
+    if await label.count() == 0:
         return None
-    label_for = label.get_attribute("for")
+    label_for = await label.get_attribute("for")
     if not label_for:
         return None
     # Some ids include ':' which is not valid in CSS selectors; use attribute selector.
-    field = page.locator(f"[id='{label_for}']").first
+    selector = f"[id='{label_for}']"
+    field = page.locator(selector).first
     try:
-        return field if field.count() > 0 else None
+        if await field.count() > 0:
+            _LABEL_CACHE[label_text] = selector
+            return field
+        return None
     except Exception:
         return None
 
 
-def guess_table(page):
+TABLE_HEADER_TOKENS = ["Trade", "Company", "License", "Expire", "Expiry"]
+
+# Index of the first table whose header cells mention a token (-1 if none), plus the table count.
+GUESS_TABLE_JS = """
+tokens => {
+  const tables = [...document.querySelectorAll('table')];
+  const idx = tables.findIndex(t => {
+    const text = [...t.querySelectorAll('th')].map(th => th.innerText).join(' ');
+    return tokens.some(token => text.includes(token));
+  });
+  return [idx, tables.length];
+}
+"""
+
+
+async def guess_table(page):
+    # One round trip instead of a header lookup per table.
+    try:
+        idx, count = await page.evaluate(GUESS_TABLE_JS, TABLE_HEADER_TOKENS)
+    except Exception:
+        return None
     tables = page.locator("table")
-    count = tables.count()
-    for idx in range(count):
-        table = tables.nth(idx)
-        try:
-            header_text = " ".join(table.locator("th").all_inner_texts())
-        except Exception:
-            header_text = ""
-        if any(token in header_text for token in ["Trade", "Company", "License", "Expire", "Expiry"]):
-            return table
+    if idx >= 0:
+        return tables.nth(idx)
     if count > 0:
         return tables.first
     return None
 
 
-def dismiss_map_popup(page):
+async def dismiss_map_popup(page):
     try:
         ok_button = page.locator("button:has-text('OK')").first
-        if ok_button.count() > 0 and ok_button.is_visible():
-            ok_button.click()
-            page.wait_for_timeout(500)
+        if await ok_button.count() > 0 and await ok_button.is_visible():
+            await ok_button.click()
+            await ok_button.wait_for(state="hidden", timeout=2000)
     except Exception:
         pass
 
 
-def paginator_next(page):
+async def paginator_next(page):
     # Prefer PrimeFaces widget paginator if available
     try:
-        worked = page.evaluate(
+        worked = await page.evaluate(
             """
 () => {
   try {
@@ -92,48 +147,74 @@ def paginator_next(page):
     for selector in SHARJAH_SEDD_SELECTORS["next_buttons"]:
         try:
             locator = page.locator(selector).first
-            if locator.count() == 0:
+            if await locator.count() == 0:
                 continue
-            classes = locator.get_attribute("class") or ""
+            classes = await locator.get_attribute("class") or ""
             if "ui-state-disabled" in classes or "disabled" in classes:
                 return None
-            locator.scroll_into_view_if_needed()
-            locator.click()
+            await locator.scroll_into_view_if_needed()
+            await locator.click()
             return True
         except Exception:
             continue
     return None
 
 
-def extract_table_rows(page):
-    rows = []
-    body = page.locator("[id='licForm:licTbl_data']")
-    if body.count() == 0:
-        return rows
-    for row in body.locator("tr").all():
-        cells = [c.inner_text().strip() for c in row.locator("td").all()]
-        if cells:
-            rows.append(cells)
-    return rows
-
-
-def extract_table_rows_generic(table):
-    rows = []
-    header_cells = table.locator("tr th")
-    header_map = {}
-    if header_cells.count() > 0:
-        headers = [h.strip() for h in header_cells.all_inner_texts()]
-        for i, header in enumerate(headers):
-            header_map[header.lower()] = i
-    data_rows = table.locator("tr")
-    for i in range(data_rows.count()):
-        row = data_rows.nth(i)
-        cells = row.locator("td")
-        if cells.count() == 0:
-            continue
-        values = [c.inner_text().strip() for c in cells.all()]
-        rows.append((values, header_map))
-    return rows
+# Whether the PrimeFaces paginator is on its last page (false when it cannot tell), plus the
+# first row's text for LICENSE_PAGE_CHANGED_JS.
+LICENSE_PAGE_STATE_JS = """
+() => {
+  let last = false;
+  try {
+    const cfg = PF('trdNameDT').paginator.cfg;
+    last = cfg.page + 1 >= cfg.pageCount;
+  } catch (e) {}
+  const row = document.querySelector("[id='licForm:licTbl_data'] tr");
+  return [last, row ? row.innerText : ''];
+}
+"""
+
+LICENSE_PAGE_CHANGED_JS = """
+(prev) => {
+  const row = document.querySelector("[id='licForm:licTbl_data'] tr");
+  return !!row && row.innerText !== prev;
+}
+"""
+
+
+# Both readers walk the table inside the browser and return only cell texts: one call per page
+# instead of one per row and cell.
+LICENSE_ROWS_JS = """
+() => {
+  const body = document.querySelector("[id='licForm:licTbl_data']");
+  if (!body) return [];
+  return Array.from(body.querySelectorAll('tr'))
+    .map(tr => Array.from(tr.querySelectorAll('td')).map(td => (td.innerText || '').trim()))
+    .filter(cells => cells.length > 0);
+}
+"""
+
+TABLE_ROWS_JS = """
+(table) => {
+  const text = el => (el.innerText || '').trim();
+  return {
+    headers: Array.from(table.querySelectorAll('tr th')).map(text),
+    rows: Array.from(table.querySelectorAll('tr'))
+      .map(tr => Array.from(tr.querySelectorAll('td')).map(text))
+      .filter(cells => cells.length > 0),
+  };
+}
+"""
+
+
+async def extract_table_rows(page):
+    return await page.evaluate(LICENSE_ROWS_JS)
+
+
+async def extract_table_rows_generic(table):
+    data = await table.evaluate(TABLE_ROWS_JS)
+    header_map = {header.lower(): i for i, header in enumerate(data["headers"])}
+    return data["rows"], header_map
 
 
 def clean_cell(text):
@@ -144,29 +225,266 @@ def clean_cell(text):
     return text.strip()
 
 
-def first_row_key(rows_data):
-    if not rows_data:
-        return ""
-    row = rows_data[0]
-    return "|".join([clean_cell(val) for val in row[:3]])
+# Lowercased once; header_map keys are lowercased by extract_table_rows_generic.
+COMPANY_HEADERS = tuple(label.lower() for label in SHARJAH_SEDD_SELECTORS["field_labels"]["company_name"])
+
+
+def resolve_column(header_map, candidates):
+    # Resolved once per table rather than matched against every row.
+    for header, idx in header_map.items():
+        if any(candidate in header for candidate in candidates):
+            return idx
+    return None
+
+
+SEARCH_ENDPOINT = SHARJAH_SEDD_URL.split("?", 1)[0]
 
 
-def find_row_value(values, header_map, candidates):
-    if header_map:
-        for header, idx in header_map.items():
-            for candidate in candidates:
-                if candidate.lower() in header:
-                    if idx < len(values):
-                        return values[idx]
-    if values:
-        return values[0]
-    return ""
+def search_response_matcher(source_id):
+    # JSF posts every AJAX request back to the page's own URL (possibly with ;jsessionid appended).
+    # On a reused tab the Search button first resets the paginator, which is a separate post to the
+    # same URL, so the search is told apart by the component that sent it.
+    source = f"faces.source={quote(source_id, safe='')}" if source_id else None
 
+    def matches(response):
+        request = response.request
+        if request.method != "POST" or not response.url.startswith(SEARCH_ENDPOINT):
+            return False
+        post_data = request.post_data or ""
+        if source:
+            return source in post_data
+        return "_pagination=true" not in post_data
 
-def save_html(raw_dir, keyword, page_number, content):
-    ensure_dir(raw_dir)
-    path = raw_dir / f"{keyword}_page_{page_number:03d}.html"
-    path.write_text(content, encoding="utf-8")
+    return matches
+
+
+# True once PrimeFaces has applied every queued AJAX response to the DOM.
+AJAX_IDLE_JS = """
+() => !window.PrimeFaces || !PrimeFaces.ajax || PrimeFaces.ajax.Queue.isEmpty()
+"""
+
+
+# Empties every text input in one round trip; the input event keeps PrimeFaces widgets in sync.
+CLEAR_INPUTS_JS = """
+() => {
+  document.querySelectorAll("input[type='text']").forEach(input => {
+    input.value = '';
+    input.dispatchEvent(new Event('input', { bubbles: true }));
+  });
+}
+"""
+
+
+# A search consumes the reCAPTCHA token; a reused form needs a fresh challenge for the next one.
+RESET_CAPTCHA_JS = """
+() => {
+  try {
+    if (window.grecaptcha && grecaptcha.reset) grecaptcha.reset();
+  } catch (e) {}
+}
+"""
+
+
+async def prepare_search_form(page):
+    # Clear any residual inputs.
+    try:
+        await page.evaluate(CLEAR_INPUTS_JS)
+    except Exception:
+        pass
+    try:
+        await page.evaluate(RESET_CAPTCHA_JS)
+    except Exception:
+        pass
+
+    input_box = await input_by_label(page, "Trade Name (English)")
+    if input_box:
+        logging.info("Using Trade Name (English) field by label.")
+        return input_box
+    return await first_visible(page, SHARJAH_SEDD_SELECTORS["search_inputs"])
+
+
+async def scrape_keyword(
+    page, keyword, args, html_dir, snapshots, out_file, writer, seen_records, prompt_lock, reuse_page=False
+):
+    logging.info("Searching keyword %s", keyword)
+    total_rows_for_keyword = 0
+    duplicates = 0
+    # The portal is loaded once per tab; later keywords search again from the form already on it.
+    if not reuse_page:
+        await page.goto(SHARJAH_SEDD_URL, wait_until="domcontentloaded")
+    input_box = await prepare_search_form(page)
+    if not input_box and reuse_page:
+        logging.info("Search form not found on the reused tab; reloading the portal for keyword %s", keyword)
+        await page.goto(SHARJAH_SEDD_URL, wait_until="domcontentloaded")
+        input_box = await prepare_search_form(page)
+    if not input_box:
+        logging.warning("Search input not found for keyword %s", keyword)
+        return total_rows_for_keyword
+    # SEDD requires minimum 4 characters; pad short terms (e.g., "oil").
+    term = keyword
+    if len(term) < 4:
+        term = term + " "
+    await input_box.fill(term)
+
+    # One console prompt at a time; the tab waiting on it is brought to the front.
+    async with prompt_lock:
+        await page.bring_to_front()
+        logging.info("Complete reCAPTCHA for keyword %s if present, then press Enter in this console...", keyword)
+        await asyncio.to_thread(input)
+
+    # Wait for the search's own AJAX round trip instead of a fixed delay; on a reused tab the
+    # previous keyword's rows are still in the table until PrimeFaces has applied the response.
+    search_button = await first_visible(page, SHARJAH_SEDD_SELECTORS["search_buttons"])
+    source_id = await search_button.get_attribute("id") if search_button else None
+    try:
+        async with page.expect_response(search_response_matcher(source_id), timeout=30000) as response_info:
+            if search_button:
+                await search_button.click()
+            else:
+                await input_box.press("Enter")
+        response = await response_info.value
+        await response.finished()
+        await page.wait_for_function(AJAX_IDLE_JS, timeout=15000)
+    except TimeoutError:
+        logging.warning("Search for keyword %s did not complete; reading whatever rendered", keyword)
+
+    page_number = 1
+    seen_page_keys = set()
+    while True:
+        await dismiss_map_popup(page)
+        save_html(snapshots, html_dir, keyword, page_number, await page.content())
+
+        # Columns: License Number, Trade name, Expire date, (button)
+        company_idx = 1
+        rows_data = await extract_table_rows(page)
+        if not rows_data:
+            table = await guess_table(page)
+            if not table:
+                logging.warning("No results table detected for keyword %s", keyword)
+                break
+            # Fallback to generic table parsing; locate the company column by its header when possible.
+            rows_data, header_map = await extract_table_rows_generic(table)
+            column = resolve_column(header_map, COMPANY_HEADERS)
+            if column is not None:
+                company_idx = column
+
+        logging.info("Keyword %s page %s: rows=%s", keyword, page_number, len(rows_data))
+        # The public view shows no contacts or activity; only the trade name differs between rows.
+        page_fields = {
+            "business_activity": "",
+            "phone": "",
+            "email": "",
+            "source": SOURCE_SHARJAH_SEDD,
+            "emirate": "Sharjah",
+            "activity_code": "",
+            "source_url": page.url,
+            "last_seen_utc": utc_now_iso(),
+            "notes": "contact_not_listed_in_sedd_public_view",
+        }
+        for values in rows_data:
+            company = clean_cell(values[company_idx]) if len(values) > company_idx else clean_cell(values[0])
+            # Keywords overlap ("petro" also finds every "petroleum" license); write each license once.
+            record_key = (clean_cell(values[0]), normalize_company_name(company))
+            if record_key in seen_records:
+                duplicates += 1
+                continue
+            seen_records.add(record_key)
+            record = {
+                **page_fields,
+                "company_name": company,
+            }
+            writer.writerow(record)
+            total_rows_for_keyword += 1
+        # Workers share the file; flushing per page keeps everything scraped so far on disk.
+        out_file.flush()
+
+        # Break if the page repeats (prevents infinite loop); the raw first row is enough to tell pages apart.
+        page_key = (len(rows_data), tuple(rows_data[0][:3]) if rows_data else ())
+        if page_key in seen_page_keys:
+            logging.info("Page content repeated for keyword %s; stopping pagination.", keyword)
+            break
+        seen_page_keys.add(page_key)
+
+        if args.max_pages and page_number >= args.max_pages:
+            break
+
+        # The paginator knows when this is the last page; no need to click Next and compare.
+        is_last, prev_first_row = await page.evaluate(LICENSE_PAGE_STATE_JS)
+        if is_last:
+            break
+        next_clicked = await paginator_next(page)
+        if not next_clicked:
+            break
+        # Proceed as soon as the table shows a different first row; a page that never changes is
+        # caught by the repeat check on the next pass.
+        try:
+            await page.wait_for_function(LICENSE_PAGE_CHANGED_JS, arg=prev_first_row, timeout=15000)
+        except TimeoutError:
+            logging.warning("Results did not change after Next for keyword %s page %s", keyword, page_number)
+
+        page_number += 1
+
+    if duplicates:
+        logging.info("Keyword %s: skipped %s rows already captured by another keyword", keyword, duplicates)
+    return total_rows_for_keyword
+
+
+async def scrape_worker(browser, queue, args, html_dir, snapshots, out_file, writer, seen_records, prompt_lock):
+    # Each worker owns a context, so JSF sessions and view state never mix between keywords in flight.
+    context = await browser.new_context()
+    # Only the results table is parsed; images, fonts, media and analytics beacons are skipped.
+    await context.route("**/*", block_heavy_resources)
+    page = await context.new_page()
+    loaded = False
+    rows_written = 0
+    try:
+        while True:
+            try:
+                keyword = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return rows_written
+            try:
+                total_rows_for_keyword = await scrape_keyword(
+                    page,
+                    keyword,
+                    args,
+                    html_dir,
+                    snapshots,
+                    out_file,
+                    writer,
+                    seen_records,
+                    prompt_lock,
+                    reuse_page=loaded,
+                )
+                logging.info("Keyword %s total rows captured: %s", keyword, total_rows_for_keyword)
+                rows_written += total_rows_for_keyword
+                loaded = True
+            except Exception as e:
+                logging.error("Scrape failed for keyword %s: %s", keyword, e)
+                # Start the next keyword from a fresh page load.
+                loaded = False
+    finally:
+        await context.close()
+
+
+async def scrape_keywords(keywords, args, html_dir, snapshots, out_file, writer):
+    prompt_lock = asyncio.Lock()
+    seen_records = set()
+    queue = asyncio.Queue()
+    for keyword in keywords:
+        queue.put_nowait(keyword)
+    workers = max(1, min(args.concurrency, len(keywords)))
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=args.headless, slow_mo=args.slowmo)
+        counts = await asyncio.gather(
+            *(
+                scrape_worker(browser, queue, args, html_dir, snapshots, out_file, writer, seen_records, prompt_lock)
+                for _ in range(workers)
+            )
+        )
+        await browser.close()
+    return sum(counts)
 
 
 def main():
@@ -175,141 +493,29 @@ def main():
     parser.add_argument("--max-pages", type=int, default=0)
     parser.add_argument("--keyword", action="append")
     parser.add_argument("--slowmo", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=3, help="keywords searched in parallel browser contexts")
     args = parser.parse_args()
 
     stamp = run_stamp()
     log_path = RAW_DIR / "sharjah_sedd" / f"run_{stamp}.log"
     setup_logger(log_path)
 
-    keywords = args.keyword or KEYWORDS
+    keywords = list(dict.fromkeys(args.keyword or KEYWORDS))
 
-    out_rows = []
     html_dir = RAW_DIR / "sharjah_sedd" / "html"
     ensure_dir(html_dir)
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=args.headless, slow_mo=args.slowmo)
-        page = browser.new_page()
-
-        for keyword in keywords:
-            logging.info("Searching keyword %s", keyword)
-            page.goto(SHARJAH_SEDD_URL, wait_until="networkidle")
-
-            # Clear any residual inputs.
-            try:
-                for field in page.locator("input[type='text']").all():
-                    field.fill("")
-            except Exception:
-                pass
-
-            input_box = input_by_label(page, "Trade Name (English)")
-            if input_box:
-                logging.info("Using Trade Name (English) field by label.")
-            else:
-                input_box = first_visible(page, SHARJAH_SEDD_SELECTORS["search_inputs"])
-            if not input_box:
-                logging.warning("Search input not found for keyword %s", keyword)
-                continue
-            # SEDD requires minimum 4 characters; pad short terms (e.g., "oil").
-            term = keyword
-            if len(term) < 4:
-                term = term + " "
-            input_box.fill(term)
-
-            logging.info("Complete reCAPTCHA if present, then press Enter in this console...")
-            input()
-
-            search_button = first_visible(page, SHARJAH_SEDD_SELECTORS["search_buttons"])
-            if search_button:
-                search_button.click()
-            else:
-                input_box.press("Enter")
-
-            page.wait_for_timeout(2000)
-
-            page_number = 1
-            total_rows_for_keyword = 0
-            seen_page_keys = set()
-            while True:
-                dismiss_map_popup(page)
-                page.wait_for_timeout(1000)
-                save_html(html_dir, keyword, page_number, page.content())
-
-                rows_data = extract_table_rows(page)
-                if not rows_data:
-                    table = guess_table(page)
-                    if not table:
-                        logging.warning("No results table detected for keyword %s", keyword)
-                        break
-                    # Fallback to generic table parsing
-                    rows_data = []
-                    for values, header_map in extract_table_rows_generic(table):
-                        rows_data.append(values)
-
-                logging.info("Keyword %s page %s: rows=%s", keyword, page_number, len(rows_data))
-                for values in rows_data:
-                    # Columns: License Number, Trade name, Expire date, (button)
-                    company = clean_cell(values[1]) if len(values) > 1 else clean_cell(values[0])
-                    activity = ""
-                    record = {
-                        "company_name": company,
-                        "business_activity": activity,
-                        "phone": "",
-                        "email": "",
-                        "source": SOURCE_SHARJAH_SEDD,
-                        "emirate": "Sharjah",
-                        "activity_code": "",
-                        "source_url": page.url,
-                        "last_seen_utc": utc_now_iso(),
-                        "notes": "contact_not_listed_in_sedd_public_view",
-                    }
-                    out_rows.append(record)
-                total_rows_for_keyword += len(rows_data)
-
-                # Break if the page repeats (prevents infinite loop).
-                page_key = f"{keyword}|{len(rows_data)}|{first_row_key(rows_data)}"
-                if page_key and page_key in seen_page_keys:
-                    logging.info("Page content repeated for keyword %s; stopping pagination.", keyword)
-                    break
-                if page_key:
-                    seen_page_keys.add(page_key)
-
-                if args.max_pages and page_number >= args.max_pages:
-                    break
-
-                next_clicked = paginator_next(page)
-                if not next_clicked:
-                    break
-                try:
-                    prev_key = first_row_key(rows_data)
-                    page.wait_for_function(
-                        """
-(prev) => {
-  const row = document.querySelector(\"[id='licForm:licTbl_data'] tr\");
-  if (!row) return false;
-  return row.innerText.trim() !== prev;
-}
-""",
-                        prev_key,
-                        timeout=15000,
-                    )
-                except Exception:
-                    page.wait_for_timeout(1500)
-
-                page_number += 1
-
-            logging.info("Keyword %s total rows captured: %s", keyword, total_rows_for_keyword)
-
-        browser.close()
-
+    # Rows are written as they are scraped; leaving the block closes the CSV and waits for
+    # pending snapshot writes.
     out_path = RAW_DIR / "sharjah_sedd" / f"sharjah_sedd_{stamp}.csv"
-    if out_rows:
-        from utils import write_csv
+    out_file, writer = open_csv_writer(out_path, OUTPUT_COLUMNS)
+    with out_file, ThreadPoolExecutor(max_workers=2) as snapshots:
+        row_count = asyncio.run(scrape_keywords(keywords, args, html_dir, snapshots, out_file, writer))
 
-        write_csv(out_rows, out_path, OUTPUT_COLUMNS)
-        logging.info("Saved %s rows to %s", len(out_rows), out_path)
+    if row_count:
+        logging.info("Saved %s rows to %s", row_count, out_path)
     else:
-        logging.warning("No rows captured")
+        logging.warning("No rows captured; %s holds only the header", out_path)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,24 @@
-﻿import csv
+﻿import atexit
+import csv
+import gzip
 import logging
+import queue
 import re
 from datetime import datetime, timezone
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from operator import itemgetter
 from pathlib import Path
 
-EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+from config import BLOCKED_RESOURCE_TYPES, BLOCKED_URL_PARTS
+
+# Used with fullmatch, so no anchors are needed.
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
 NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+NON_DIGIT_RE = re.compile(r"\D+")
+# str.translate tables for the ASCII fast paths; the regexes above still handle any other input.
+ASCII_NON_ALNUM_TO_SPACE = str.maketrans({c: " " for c in map(chr, range(128)) if not (c.isdigit() or "a" <= c <= "z")})
+ASCII_NON_DIGITS = str.maketrans("", "", "".join(c for c in map(chr, range(128)) if not c.isdigit()))
 
 
 def utc_now_iso():
@@ -20,32 +33,117 @@ def ensure_dir(path: Path):
     path.mkdir(parents=True, exist_ok=True)
 
 
+def row_getter(fieldnames):
+    # Picks a dict row's values in column order in one C call; rows must hold every field,
+    # extra keys are ignored. itemgetter returns a bare value for a single field, so wrap that case.
+    fieldnames = tuple(fieldnames)
+    if len(fieldnames) == 1:
+        key = fieldnames[0]
+        return lambda row: (row[key],)
+    return itemgetter(*fieldnames)
+
+
 def write_csv(rows, path: Path, fieldnames):
     ensure_dir(path.parent)
     with path.open("w", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
-        writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        # rows may be any iterable, including a generator; it is consumed once.
+        writer.writerows(map(row_getter(fieldnames), rows))
+
+
+def block_heavy_resources(route):
+    # context.route handler for both Playwright APIs (the async one awaits the returned coroutine).
+    # reCAPTCHA requests always pass so a human can still solve the challenge.
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES and "recaptcha" not in request.url:
+        return route.abort()
+    if any(part in request.url for part in BLOCKED_URL_PARTS):
+        return route.abort()
+    return route.continue_()
+
+
+# Selector that last matched for each fallback list; tried first on the next lookup.
+_SELECTOR_CACHE = {}
+
+# One round trip classifies every candidate: "visible", "missing", or "other" (hidden, or a
+# Playwright-only selector that querySelector cannot parse, which is probed the slow way).
+SELECTOR_STATES_JS = """
+(sels) => sels.map((s) => {
+  let el;
+  try {
+    el = document.querySelector(s);
+  } catch (e) {
+    return "other";
+  }
+  if (!el) return "missing";
+  const rects = el.getClientRects().length;
+  return rects && getComputedStyle(el).visibility !== "hidden" ? "visible" : "other";
+})
+"""
+
+
+def selector_candidates(selectors):
+    # first_visible walks candidates strictly in this order (last match first, then the fallback list),
+    # taking the slow Playwright probe in place for any it could not classify.
+    cached = _SELECTOR_CACHE.get(tuple(selectors))
+    if cached:
+        return [cached] + [selector for selector in selectors if selector != cached]
+    return list(selectors)
+
+
+def remember_selector(selectors, selector):
+    _SELECTOR_CACHE[tuple(selectors)] = selector
+
+
+def open_csv_writer(path: Path, fieldnames, buffering=1 << 20):
+    # For scrapers that stream rows as they are found; the caller closes the returned file.
+    ensure_dir(path.parent)
+    f = path.open("w", encoding="utf-8", newline="", buffering=buffering)
+    writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+    writer.writeheader()
+    return f, writer
+
+
+def write_gzip_text(path: Path, content: str, compresslevel=3):
+    ensure_dir(path.parent)
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=compresslevel) as f:
+        f.write(content)
+
+
+def log_failed_write(future):
+    if future.exception():
+        logging.warning("Background write failed: %s", future.exception())
+
+
+def save_html(executor, raw_dir: Path, name, page_number, content):
+    # Page snapshots are gzip-compressed on the executor so scraping never waits on disk.
+    path = raw_dir / f"{name}_page_{page_number:03d}.html.gz"
+    executor.submit(write_gzip_text, path, content).add_done_callback(log_failed_write)
 
 
 def append_csv(rows, path: Path, fieldnames):
     ensure_dir(path.parent)
     file_exists = path.exists()
     with path.open("a", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer = csv.writer(f)
         if not file_exists:
-            writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
+            writer.writerow(fieldnames)
+        writer.writerows(map(row_getter(fieldnames), rows))
 
 
 def setup_logger(log_path: Path):
     ensure_dir(log_path.parent)
+    # Log calls only format and enqueue the line; a listener thread writes it to the file and console.
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, logging.FileHandler(log_path, encoding="utf-8"), logging.StreamHandler())
+    listener.start()
+    # Stopping drains the queue, so nothing logged before exit is lost.
+    atexit.register(listener.stop)
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[logging.FileHandler(log_path, encoding="utf-8"), logging.StreamHandler()],
+        handlers=[QueueHandler(log_queue)],
     )
 
 
@@ -53,45 +151,48 @@ def validate_email(value: str):
     if not value:
         return ""
     value = value.strip()
-    if EMAIL_RE.match(value):
+    # Most scraped cells are blank or plain text; skip the regex unless an "@" is present.
+    if "@" in value and EMAIL_RE.fullmatch(value):
         return value
     return ""
 
 
+@lru_cache(maxsize=65536)
 def normalize_company_name(value: str):
     if not value:
         return ""
     lowered = value.strip().lower()
-    normalized = NON_ALNUM_RE.sub(" ", lowered)
+    if lowered.isascii():
+        normalized = lowered.translate(ASCII_NON_ALNUM_TO_SPACE)
+    else:
+        normalized = NON_ALNUM_RE.sub(" ", lowered)
     return " ".join(normalized.split())
 
 
+@lru_cache(maxsize=65536)
 def normalize_phone(value: str):
     if not value:
         return ""
-    digits = re.sub(r"\D+", "", value)
+    digits = value.translate(ASCII_NON_DIGITS)
+    if not digits.isdecimal():
+        # Non-ASCII leftovers (e.g. direction marks around Arabic-formatted numbers).
+        digits = NON_DIGIT_RE.sub("", digits)
     if not digits:
         return ""
     if digits.startswith("00971"):
-        digits = "971" + digits[5:]
-    if digits.startswith("971"):
-        return "+" + digits
+        digits = digits[2:]
     return "+" + digits
 
 
 def merge_notes(*values):
-    parts = []
+    # dict keys keep first-seen order and make the duplicate check O(1).
+    parts = {}
     for value in values:
         if not value:
             continue
-        if isinstance(value, str):
-            for item in value.split(";"):
-                item = item.strip()
-                if item and item not in parts:
-                    parts.append(item)
-        else:
-            for item in value:
-                item = str(item).strip()
-                if item and item not in parts:
-                    parts.append(item)
+        items = value.split(";") if isinstance(value, str) else value
+        for item in items:
+            item = str(item).strip()
+            if item:
+                parts[item] = None
     return ";".join(parts)